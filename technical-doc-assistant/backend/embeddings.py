@@ -1,16 +1,28 @@
 # backend/embeddings.py
 
 import os
+import json
+import hashlib
+import struct
+import asyncio
+import functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Iterable, Tuple
 from pinecone import Pinecone
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
+# Splitting, dedup and batch packing live in a module that can be compiled with mypyc
+from embeddings_fast import Chunk, group_duplicates, pack_batches
+
 # --- Initialization ---
 load_dotenv() # Load environment variables from .env file
 
-# Initialize OpenAI client
+# Initialize OpenAI clients; the async one lets embedding batches run concurrently
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # --- NEW PINECOME INITIALIZATION ---
 # This is the updated, correct way to initialize the Pinecone client
@@ -20,73 +32,349 @@ pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
 
 # --- Configuration ---
 PINECONE_INDEX_NAME = "doc-assistant" # Use the index name you created
-EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512 # Truncated embeddings; the Pinecone index must be created with this dimension
 PINECONE_BATCH_SIZE = 100 # Recommended batch size for upserting
+EMBEDDING_CONCURRENCY = 8 # Max embedding requests in flight at once
+CHUNK_WINDOW_SIZE = 2000 # Chunks held in memory (and sorted by length) per embedding round
+EMBEDDING_CACHE_TTL_SECONDS = 30 * 24 * 3600 # Embeddings can be reused across repos for 30 days
+PINECONE_POOL_THREADS = 30 # Threads used by the index client for parallel upserts
+BATCH_POLL_INTERVAL_SECONDS = 30 # How often to check on an OpenAI Batch API job
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+BATCH_MAX_INPUTS = 50_000 # Batch API ceiling on embedding inputs per job, summed over its requests
+BATCH_COMPLETION_WINDOW = "24h"
+INDEXING_THREADS = 8 # Worker threads shared by all indexing jobs (each uses up to two at once)
+
+# Create the index handle once: its upsert thread pool lives for the whole process,
+# so a handle per indexing run would leak PINECONE_POOL_THREADS threads each time.
+# pool_threads lets us send upserts in parallel with async_req=True
+INDEX = pc.Index(PINECONE_INDEX_NAME, pool_threads=PINECONE_POOL_THREADS)
+
+# Clones, file reads and bulk upserts can hold a thread for minutes. Giving them their own
+# bounded pool keeps the default executor free for the Pinecone calls /query makes.
+indexing_executor = ThreadPoolExecutor(max_workers=INDEXING_THREADS, thread_name_prefix="indexing")
+
+async def run_in_indexing_thread(func, *args, **kwargs):
+    """Runs a blocking indexing step on indexing_executor without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(indexing_executor, functools.partial(func, *args, **kwargs))
+
+# --- Embedding Cache (Redis) ---
+# Embeddings are keyed by content digest, so identical text is only paid for once across repos.
+# Vectors are stored int8-quantized with one float32 scale: ~4x smaller than float32,
+# with negligible effect on top-k retrieval.
+def _embedding_cache_key(digest: bytes) -> str:
+    return f"emb:q8:{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{digest.hex()}"
+
+def _pack_embedding(embedding: list) -> bytes:
+    """Quantizes to int8 with a per-vector scale, prefixed as little-endian float32."""
+    values = np.asarray(embedding, dtype=np.float32)
+    scale = float(np.abs(values).max()) / 127 or 1.0
+    quantized = np.round(values / scale).astype(np.int8)
+    return struct.pack("<f", scale) + quantized.tobytes()
+
+def _unpack_embedding(raw: bytes) -> list:
+    (scale,) = struct.unpack_from("<f", raw)
+    quantized = np.frombuffer(raw, dtype=np.int8, offset=4)
+    return (quantized.astype(np.float32) * scale).tolist()
+
+async def _get_cached_embeddings(cache, digests: list) -> list:
+    """Returns one cached embedding (or None) per digest, using a single MGET."""
+    if cache is None or not digests:
+        return [None] * len(digests)
+    try:
+        raw_values = await cache.mget([_embedding_cache_key(d) for d in digests])
+        return [_unpack_embedding(raw) if raw else None for raw in raw_values]
+    except Exception as e:
+        print(f"Error reading embedding cache from Redis: {e}")
+        return [None] * len(digests)
+
+async def _set_cached_embeddings(cache, entries: list):
+    """Writes (digest, embedding) pairs to the cache in one pipelined round-trip."""
+    if cache is None or not entries:
+        return
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            for digest, embedding in entries:
+                pipe.setex(_embedding_cache_key(digest), EMBEDDING_CACHE_TTL_SECONDS, _pack_embedding(embedding))
+            await pipe.execute()
+    except Exception as e:
+        print(f"Error writing embedding cache to Redis: {e}")
 
 # --- Core Functions ---
-def get_text_chunks(documents: list) -> list:
-    """Splits documents into smaller chunks for embedding."""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    
-    chunks = []
-    for doc in documents:
-        split_chunks = text_splitter.create_documents(
-            [doc['content']], 
-            metadatas=[{"source": doc['source']}]
-        )
-        for chunk in split_chunks:
-            chunks.append(chunk)
-            
-    print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
-    return chunks
+async def _embed_batch(texts_to_embed: list, semaphore: asyncio.Semaphore) -> list | None:
+    """Embeds one batch of texts, waiting on the semaphore to cap in-flight requests."""
+    try:
+        async with semaphore:
+            res = await async_openai_client.embeddings.create(input=texts_to_embed, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        return [record.embedding for record in res.data]
+    except Exception as e:
+        print(f"Error creating embeddings with OpenAI: {e}")
+        return None
 
-def create_embeddings_and_upsert(chunks: list, repo_id: str):
+async def create_embeddings_and_upsert(chunks: Iterable[Chunk], repo_id: str, embedding_cache=None) -> int:
     """
     Creates embeddings for text chunks and upserts them into the Pinecone index.
     Uses the repo_id as a Pinecone namespace to keep data separate.
+    Chunks are consumed one window at a time, so memory stays bounded by CHUNK_WINDOW_SIZE;
+    within a window, token-packed embedding batches are requested concurrently.
+    If embedding_cache (a redis.asyncio client that does not decode responses) is given,
+    previously seen texts are served from it instead of OpenAI.
+    Returns the number of chunks processed.
     """
-    if not chunks:
-        print("No chunks to process.")
-        return
-
-    # <-- CHANGE: Get a handler for the index from our Pinecone instance
-    index = pc.Index(PINECONE_INDEX_NAME)
+    print(f"Streaming chunks into Pinecone namespace: {repo_id}")
     
-    print(f"Preparing to upsert {len(chunks)} chunks into Pinecone namespace: {repo_id}")
-    
-    # Process in batches to stay within Pinecone's limits
-    for i in range(0, len(chunks), PINECONE_BATCH_SIZE):
-        batch_chunks = chunks[i:i + PINECONE_BATCH_SIZE]
+    chunks = iter(chunks)
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    pending_upsert = None
+    chunk_offset = 0
+    while True:
+        # Pulling from the generator clones, reads and splits files, so keep it off the event loop
+        window = await run_in_indexing_thread(lambda: list(islice(chunks, CHUNK_WINDOW_SIZE)))
+        if not window:
+            break
+        
+        # Embed each distinct text once (license headers, boilerplate, generated code...)
+        groups = group_duplicates(window)
+        digests = list(groups)
+        unique_chunks = [window[group[0]] for group in groups.values()]
+        if len(unique_chunks) < len(window):
+            print(f"Skipping {len(window) - len(unique_chunks)} duplicate chunks in this window.")
+        
+        # Only texts missing from the cache go to OpenAI
+        embeddings_by_unique = await _get_cached_embeddings(embedding_cache, digests)
+        misses = [u for u, embedding in enumerate(embeddings_by_unique) if embedding is None]
+        if len(misses) < len(unique_chunks):
+            print(f"Reusing {len(unique_chunks) - len(misses)} cached embeddings in this window.")
+        
+        # Each batch is a list of indices into misses
+        batches = pack_batches([unique_chunks[u] for u in misses])
         
-        texts_to_embed = [chunk.page_content for chunk in batch_chunks]
+        # gather() returns results in submission order, so embeddings_by_batch[n] belongs to batches[n]
+        embeddings_by_batch = await asyncio.gather(
+            *(_embed_batch([unique_chunks[misses[m]][1] for m in batch], semaphore) for batch in batches)
+        )
+        
+        new_cache_entries = []
+        for batch, embeddings in zip(batches, embeddings_by_batch):
+            if embeddings is None:
+                continue
+            for m, embedding in zip(batch, embeddings):
+                u = misses[m]
+                embeddings_by_unique[u] = embedding
+                new_cache_entries.append((digests[u], embedding))
+        await _set_cached_embeddings(embedding_cache, new_cache_entries)
+        
+        # Every copy of a text shares its embedding but keeps its own ID and source.
+        # IDs use each chunk's position in the original stream, not its sorted position.
+        positions, values = _expand_groups(groups.values(), embeddings_by_unique)
+        vectors_to_upsert = _build_vectors(
+            [f"{repo_id}-{chunk_offset + k}" for k in positions],
+            values,
+            [{"text": window[k][1], "source": window[k][0]} for k in positions]
+        )
         
+        # Let this window's upserts run while the next window is embedded
+        if pending_upsert:
+            await pending_upsert
+        pending_upsert = asyncio.create_task(
+            run_in_indexing_thread(_upsert_in_parallel, INDEX, vectors_to_upsert, repo_id)
+        )
+        chunk_offset += len(window)
+
+    if pending_upsert:
+        await pending_upsert
+    
+    if not chunk_offset:
+        print("No chunks to process.")
+    else:
+        print("Embedding and upsert process completed.")
+    return chunk_offset
+
+def _expand_groups(groups: Iterable[list], embeddings: Iterable[list | None]) -> Tuple[list, list]:
+    """
+    Fans each embedding out to every chunk position in its group, skipping failed embeddings.
+    Returns parallel (positions, values) lists; values reference the embeddings without copying.
+    """
+    positions, values = [], []
+    for group, embedding in zip(groups, embeddings):
+        if embedding is None:
+            continue
+        positions.extend(group)
+        values.extend([embedding] * len(group))
+    return positions, values
+
+def _build_vectors(ids: list, values: list, metadatas: list) -> list:
+    """Zips parallel id/value/metadata lists into Pinecone vector dicts in a single pass."""
+    return [{"id": i, "values": v, "metadata": m} for i, v, m in zip(ids, values, metadatas)]
+
+def _upsert_in_parallel(index, vectors: list, repo_id: str):
+    """Upserts vectors in PINECONE_BATCH_SIZE batches, submitting every batch before waiting on any."""
+    upsert_results = []
+    for i in range(0, len(vectors), PINECONE_BATCH_SIZE):
+        batch_vectors = vectors[i:i + PINECONE_BATCH_SIZE]
         try:
-            res = openai_client.embeddings.create(input=texts_to_embed, model=EMBEDDING_MODEL)
-            embeddings = [record.embedding for record in res.data]
+            upsert_results.append(
+                (i // PINECONE_BATCH_SIZE, index.upsert(vectors=batch_vectors, namespace=repo_id, async_req=True))
+            )
         except Exception as e:
-            print(f"Error creating embeddings with OpenAI: {e}")
-            continue
+            # A batch that can't even be submitted shouldn't stop the remaining ones
+            print(f"Error upserting to Pinecone: {e}")
 
-        vectors_to_upsert = []
-        for j, chunk in enumerate(batch_chunks):
-            vector = {
-                "id": f"{repo_id}-{i+j}",
-                "values": embeddings[j],
-                "metadata": {
-                    "text": chunk.page_content,
-                    "source": chunk.metadata["source"]
-                }
-            }
-            vectors_to_upsert.append(vector)
-            
+    for batch_num, async_result in upsert_results:
         try:
-            index.upsert(vectors=vectors_to_upsert, namespace=repo_id)
-            print(f"Successfully upserted batch {i // PINECONE_BATCH_SIZE + 1}")
+            async_result.get()
+            print(f"Successfully upserted batch {batch_num + 1}")
         except Exception as e:
             print(f"Error upserting to Pinecone: {e}")
 
-    print("Embedding and upsert process completed.")
\ No newline at end of file
+# --- OpenAI Batch API (cheaper, slower path for background indexing) ---
+def _plan_batch_requests(chunks: list) -> Tuple[list, list]:
+    """
+    Groups duplicate chunks and packs the unique texts into embedding requests.
+    Returns (groups, requests), where each request lists the groups whose texts it embeds.
+    Deterministic for a given chunk list, so the results can be mapped back after the batch runs.
+    """
+    groups = list(group_duplicates(chunks).values())
+    requests = pack_batches([chunks[group[0]] for group in groups])
+    return groups, requests
+
+def _split_into_jobs(requests: list) -> list:
+    """
+    Splits packed requests into consecutive slices that each stay under BATCH_MAX_INPUTS.
+    Returns (first_request, end_request) ranges, one per Batch API job.
+    """
+    jobs = []
+    start, inputs = 0, 0
+    for n, request in enumerate(requests):
+        if inputs and inputs + len(request) > BATCH_MAX_INPUTS:
+            jobs.append((start, n))
+            start, inputs = n, 0
+        inputs += len(request)
+    if start < len(requests):
+        jobs.append((start, len(requests)))
+    return jobs
+
+def batch_plan_fingerprint(chunks: list) -> str:
+    """
+    Digest of the chunk list a batch was planned from. Results are mapped back to chunks by
+    position, so a batch can only be resumed against a re-read repo with the same fingerprint.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for source, text, _ in chunks:
+        h.update(source.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def create_embeddings_via_batch_api(chunks: list, repo_id: str) -> list:
+    """
+    Submits embedding requests for every unique chunk text as OpenAI Batch API jobs.
+    Each request carries a token-packed array of inputs, and requests are spread over as many
+    jobs as it takes to keep each one under the per-job input limit.
+    Returns the batch ids; use wait_for_embedding_batch to upsert the results.
+    """
+    groups, requests = _plan_batch_requests(chunks)
+    
+    batch_ids = []
+    for job_num, (first, end) in enumerate(_split_into_jobs(requests)):
+        lines = []
+        for n in range(first, end):
+            lines.append(json.dumps({
+                "custom_id": f"{repo_id}-request-{n}",
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {
+                    "model": EMBEDDING_MODEL,
+                    "input": [chunks[groups[g][0]][1] for g in requests[n]],
+                    "dimensions": EMBEDDING_DIMENSIONS
+                }
+            }))
+        
+        batch_file = openai_client.files.create(
+            file=(f"{repo_id}-embeddings-{job_num}.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/embeddings",
+            completion_window=BATCH_COMPLETION_WINDOW
+        )
+        print(f"Submitted embedding batch {batch.id} with {len(lines)} requests for {repo_id}")
+        batch_ids.append(batch.id)
+    return batch_ids
+
+def get_embedding_batch_status(batch_ids: list) -> dict:
+    """Reports the combined progress of a repo's embedding batch jobs."""
+    statuses, completed, total = [], 0, 0
+    for batch_id in batch_ids:
+        batch = openai_client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        statuses.append(batch.status)
+        completed += counts.completed if counts else 0
+        total += counts.total if counts else 0
+    
+    # Report the least finished job, so the repo only looks done once every job is
+    unfinished = [status for status in statuses if status not in BATCH_TERMINAL_STATUSES]
+    failed = [status for status in statuses if status != "completed"]
+    return {
+        "batch_status": (unfinished or failed or ["completed"])[0],
+        "completed": completed,
+        "total": total
+    }
+
+async def wait_for_embedding_batch(batch_ids: list, chunks: list, repo_id: str) -> bool:
+    """
+    Polls a repo's batch jobs until they all finish, then upserts the returned embeddings.
+    Waits between polls on the event loop, so a job that takes hours doesn't hold a worker
+    thread; only the API calls and the final upsert run in threads.
+    Returns True if every job completed and the results were upserted.
+    """
+    output_file_ids = []
+    for batch_id in batch_ids:
+        batch = await run_in_indexing_thread(openai_client.batches.retrieve, batch_id)
+        while batch.status not in BATCH_TERMINAL_STATUSES:
+            await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+            batch = await run_in_indexing_thread(openai_client.batches.retrieve, batch_id)
+        
+        if batch.status != "completed" or not batch.output_file_id:
+            print(f"Embedding batch {batch_id} ended with status '{batch.status}'.")
+            return False
+        output_file_ids.append(batch.output_file_id)
+    
+    await run_in_indexing_thread(_upsert_batch_output, output_file_ids, chunks, repo_id)
+    print(f"Embedding batches {', '.join(batch_ids)} finished for {repo_id}.")
+    return True
+
+def _upsert_batch_output(output_file_ids: list, chunks: list, repo_id: str):
+    """Downloads finished batches' embeddings and upserts them for every chunk."""
+    embeddings_by_id = {}
+    for output_file_id in output_file_ids:
+        output = openai_client.files.content(output_file_id).text
+        for line in output.splitlines():
+            result = json.loads(line)
+            response = result.get("response")
+            if result.get("error") or not response or response["status_code"] != 200:
+                print(f"Error creating embeddings for {result.get('custom_id')}: {result.get('error')}")
+                continue
+            data = sorted(response["body"]["data"], key=lambda item: item["index"])
+            embeddings_by_id[result["custom_id"]] = [item["embedding"] for item in data]
+    
+    # Spread each request's embeddings back over its groups, then over every chunk sharing that text
+    groups, requests = _plan_batch_requests(chunks)
+    group_embeddings = [None] * len(groups)
+    for n, request in enumerate(requests):
+        embeddings = embeddings_by_id.get(f"{repo_id}-request-{n}")
+        if embeddings:
+            for g, embedding in zip(request, embeddings):
+                group_embeddings[g] = embedding
+    positions, values = _expand_groups(groups, group_embeddings)
+    vectors_to_upsert = _build_vectors(
+        [f"{repo_id}-{k}" for k in positions],
+        values,
+        [{"text": chunks[k][1], "source": chunks[k][0]} for k in positions]
+    )
+    
+    _upsert_in_parallel(INDEX, vectors_to_upsert, repo_id)
+    print(f"Upserted {len(vectors_to_upsert)} vectors from the embedding batch for {repo_id}.")
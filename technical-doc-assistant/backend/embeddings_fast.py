@@ -0,0 +1,95 @@
+# backend/embeddings_fast.py
+
+# CPU-bound parts of the indexing pipeline: splitting, duplicate grouping and batch packing.
+# Everything here is fully annotated so it can be compiled with mypyc (see the Dockerfile);
+# the module works unchanged as plain Python when it isn't compiled.
+
+import hashlib
+from itertools import islice
+from typing import Dict, Final, Iterable, Iterator, List, Tuple
+import tiktoken
+from semantic_text_splitter import TextSplitter
+
+# (source, chunk_text, token_count)
+Chunk = Tuple[str, str, int]
+
+# --- Configuration ---
+TOKENIZER_MODEL: Final = "text-embedding-3-small" # Chunks are sized with this model's tokenizer
+CHUNK_SIZE: Final = 256 # Tokens per chunk (~1000 characters); far below the model's 8191-token input cap
+CHUNK_OVERLAP: Final = 50 # Tokens shared between neighbouring chunks
+EMBEDDING_BATCH_TOKEN_BUDGET: Final = 40_000 # Tokens packed into one embedding request (API ceiling is 300k)
+EMBEDDING_BATCH_MAX_INPUTS: Final = 2048 # Max inputs the embeddings endpoint accepts per request
+SPLIT_WINDOW_SIZE: Final = 64 # Documents handed to the splitter per call
+
+# The Rust-backed splitter is stateless between calls, so build it once.
+# It measures chunks with the model's own tokenizer and binary-searches each chunk
+# boundary internally, so no chunk can exceed CHUNK_SIZE tokens.
+text_splitter = TextSplitter.from_tiktoken_model(TOKENIZER_MODEL, CHUNK_SIZE, overlap=CHUNK_OVERLAP)
+
+# Python-side tokenizer for the per-chunk counts used in batch packing, loaded once
+encoding = tiktoken.get_encoding("cl100k_base")
+
+# --- Splitting ---
+def get_text_chunks(documents: Iterable[Tuple[str, str]]) -> Iterator[Chunk]:
+    """
+    Lazily splits (source, content) documents into (source, chunk_text, token_count) for embedding.
+    """
+    doc_iter = iter(documents)
+    doc_count = 0
+    chunk_count = 0
+    while True:
+        window: List[Tuple[str, str]] = list(islice(doc_iter, SPLIT_WINDOW_SIZE))
+        if not window:
+            break
+        
+        # Split a window of documents in a single call instead of once per document
+        split_texts: List[List[str]] = text_splitter.chunk_all([content for _, content in window])
+        for (source, _), doc_chunks in zip(window, split_texts):
+            # Count tokens for all of this document's chunks in one (GIL-releasing) call
+            token_counts = [len(tokens) for tokens in encoding.encode_ordinary_batch(doc_chunks)]
+            for chunk_text, token_count in zip(doc_chunks, token_counts):
+                chunk_count += 1
+                yield source, chunk_text, token_count
+        doc_count += len(window)
+            
+    print(f"Split {doc_count} documents into {chunk_count} chunks.")
+
+# --- Deduplication and Batching ---
+def group_duplicates(chunks: List[Chunk]) -> Dict[bytes, List[int]]:
+    """
+    Groups chunks with identical text so each unique text is embedded only once.
+    Maps a digest of each unique text to its indices in `chunks`, in first-seen order.
+    """
+    groups: Dict[bytes, List[int]] = {}
+    for k in range(len(chunks)):
+        key = hashlib.blake2b(chunks[k][1].encode("utf-8"), digest_size=16).digest()
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [k]
+        else:
+            group.append(k)
+    return groups
+
+def pack_batches(chunks: List[Chunk]) -> List[List[int]]:
+    """
+    Groups chunks into embedding requests by cumulative token count rather than a fixed size.
+    Chunks are sorted by length first so each request holds similarly sized inputs.
+    Returns lists of indices into `chunks`, so callers can keep the original ordering.
+    """
+    order = sorted(range(len(chunks)), key=lambda k: chunks[k][2])
+    
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for k in order:
+        token_count = chunks[k][2]
+        if current and (current_tokens + token_count > EMBEDDING_BATCH_TOKEN_BUDGET
+                        or len(current) >= EMBEDDING_BATCH_MAX_INPUTS):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(k)
+        current_tokens += token_count
+    if current:
+        batches.append(current)
+    return batches
@@ -2,56 +2,127 @@
 
 import os
 import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from git import Repo
 from pathlib import Path
-from typing import List
+from typing import Iterator, Tuple
 
 # Define which file extensions we want to process
 ALLOWED_EXTENSIONS = {".py", ".js", ".ts", ".java", ".md", ".txt"}
+MAX_FILE_SIZE_BYTES = 1_000_000 # Skip pathological blobs (bundles, data dumps, etc.)
+MAX_REPO_BYTES = 50_000_000 # Stop reading files once this much content has been yielded
+# Directories holding dependencies, build output or VCS data; pruned during traversal
+EXCLUDED_DIRS = {"node_modules", "dist", "build", ".git", "venv", ".venv", "__pycache__"}
+BINARY_SNIFF_BYTES = 4096 # A NUL byte in this prefix marks the file as binary
+MAX_AVG_LINE_LENGTH = 200 # Code averaging longer lines than this is almost certainly minified
+PROSE_EXTENSIONS = {".md", ".txt"} # Long lines are normal here, so skip the minified check
+FILE_READ_WORKERS = 16 # File I/O releases the GIL, so threads overlap the reads
+FILE_READ_WINDOW = 64 # Files read ahead of the consumer, bounding how much content is held in memory
 
-def load_github_repo(repo_url: str, local_path: str = "temp_repo") -> List[dict]:
+def _sparse_checkout_patterns() -> list:
     """
-    Clones a GitHub repository, extracts content, and cleans up.
+    Non-cone sparse-checkout patterns: only allowed extensions, never excluded directories.
+    """
+    patterns = [f"*{ext}" for ext in sorted(ALLOWED_EXTENSIONS)]
+    patterns += [f"!**/{d}/**" for d in sorted(EXCLUDED_DIRS)]
+    return patterns
+
+def _read_file(file_path: Path, repo_path: Path) -> Tuple[str, str] | None:
+    """
+    Reads a single file, returning (source, content) or None if it could not be read.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if b"\0" in f.read(BINARY_SNIFF_BYTES):
+                return None
+        
+        # Undecodable bytes are replaced rather than failing the whole file
+        content = file_path.read_text(encoding="utf-8", errors="replace")
+        if file_path.suffix not in PROSE_EXTENSIONS:
+            if len(content) / (content.count("\n") + 1) > MAX_AVG_LINE_LENGTH:
+                print(f"Skipping minified file {file_path}", flush=True)
+                return None
+        return str(file_path.relative_to(repo_path)), content
+    except Exception as e:
+        print(f"ERROR reading file {file_path}: {e}", flush=True)
+        return None
+
+def load_github_repo(repo_url: str, local_path: str | None = None) -> Iterator[Tuple[str, str]]:
+    """
+    Clones a GitHub repository and yields (source, content) for each file as it is read.
+    Without a local_path each call clones into its own temporary directory, so concurrent
+    indexing jobs never share a checkout. The clone is cleaned up once the generator is
+    exhausted or closed. Clone and traversal errors are re-raised so a partial repo is never
+    indexed; a single file that can't be read is logged and skipped by _read_file.
     """
     print(f"--- GITHUB LOADER START for URL: {repo_url} ---", flush=True)
     
-    print(f"Checking if temporary path '{local_path}' exists...", flush=True)
-    if os.path.exists(local_path):
+    if local_path is None:
+        local_path = tempfile.mkdtemp(prefix="repo_")
+        print(f"Cloning into temporary path '{local_path}'", flush=True)
+    elif os.path.exists(local_path):
         print(f"Temporary path '{local_path}' exists. Removing it.", flush=True)
         shutil.rmtree(local_path)
     
     try:
         print(f"Attempting to clone repository from {repo_url}...", flush=True)
-        #Repo.clone_from(repo_url, local_path, depth=1)
-        Repo.clone_from(repo_url, local_path)
+        # Partial clone: fetch commits and trees now, blobs only when they are checked out.
+        # Sparse checkout then materializes just the files we can actually index.
+        repo = Repo.clone_from(repo_url, local_path, depth=1, filter="blob:none", sparse=True)
+        repo.git.sparse_checkout("set", "--no-cone", *_sparse_checkout_patterns())
         print("--- CLONE SUCCEEDED ---", flush=True)
         
-        documents = []
         repo_path = Path(local_path)
         
         print("Starting to iterate through files in the cloned repository...", flush=True)
+        file_paths = []
+        for root, dirs, files in os.walk(repo_path):
+            # Prune in place so os.walk never descends into excluded directories
+            dirs[:] = [d for d in dirs if d not in EXCLUDED_DIRS]
+            for name in files:
+                file_path = Path(root) / name
+                if file_path.suffix not in ALLOWED_EXTENSIONS or not file_path.is_file():
+                    continue
+                
+                size = file_path.stat().st_size
+                if size > MAX_FILE_SIZE_BYTES:
+                    print(f"Skipping large file {file_path}", flush=True)
+                    continue
+                file_paths.append((file_path, size))
+        
+        print(f"Reading {len(file_paths)} files with {FILE_READ_WORKERS} workers...", flush=True)
         file_count = 0
-        for file_path in repo_path.rglob("*"):
-            if file_path.is_file() and file_path.suffix in ALLOWED_EXTENSIONS:
-                try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                    
-                    relative_path = str(file_path.relative_to(repo_path))
-                    documents.append({"source": relative_path, "content": content})
+        total_bytes = 0
+        budget_reached = False
+        with ThreadPoolExecutor(max_workers=FILE_READ_WORKERS) as executor:
+            # Read one window at a time so only a bounded number of files sit in memory
+            for i in range(0, len(file_paths), FILE_READ_WINDOW):
+                if budget_reached:
+                    break
+                window = file_paths[i:i + FILE_READ_WINDOW]
+                docs = executor.map(lambda p: _read_file(p[0], repo_path), window)
+                for (file_path, size), doc in zip(window, docs):
+                    # Only files that were actually read count toward the budget,
+                    # so skipped binaries and minified bundles don't use it up
+                    if doc is None:
+                        continue
+                    if total_bytes + size > MAX_REPO_BYTES:
+                        print(f"Reached the {MAX_REPO_BYTES} byte limit at {file_path}; stopping.", flush=True)
+                        budget_reached = True
+                        break
+                    total_bytes += size
                     file_count += 1
-                except Exception as e:
-                    print(f"ERROR reading file {file_path}: {e}", flush=True)
+                    yield doc
         
         print(f"Finished iterating. Found and read {file_count} files.", flush=True)
-        print("--- GITHUB LOADER RETURNING DOCUMENTS ---", flush=True)
-        return documents
 
     except Exception as e:
         print(f"--- FATAL ERROR IN GITHUB LOADER (during clone or processing) ---", flush=True)
         print(f"Exception Type: {type(e).__name__}", flush=True)
         print(f"Exception Details: {e}", flush=True)
-        return []
+        # Stopping quietly would let the caller index whatever was yielded before the error
+        raise
     finally:
         print("--- GITHUB LOADER FINALLY BLOCK ---", flush=True)
         if os.path.exists(local_path):
@@ -1,22 +1,46 @@
 # backend/main.py
 
-import redis
+import redis.asyncio as redis
 import json
+import asyncio
+import hashlib
 import os
 from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 
 from github_loader import load_github_repo
-from embeddings import get_text_chunks, create_embeddings_and_upsert
-from rag_engine import get_context, generate_answer
+from embeddings_fast import get_text_chunks
+from embeddings import (
+    create_embeddings_and_upsert,
+    batch_plan_fingerprint,
+    create_embeddings_via_batch_api,
+    get_embedding_batch_status,
+    run_in_indexing_thread,
+    wait_for_embedding_batch,
+)
+from rag_engine import (
+    aembed_question,
+    aget_context,
+    aget_semantic_cache,
+    aset_semantic_cache,
+    astream_answer,
+)
 
 from fastapi.middleware.cors import CORSMiddleware
 
 # --- Configuration & Setup ---
 load_dotenv()
 
+# Index through OpenAI's Batch API (half the cost, up to 24h turnaround) instead of live requests
+USE_EMBEDDING_BATCH_API = os.getenv("USE_EMBEDDING_BATCH_API", "false").lower() == "true"
+REDIS_MAX_CONNECTIONS = 32
+CACHE_TTL_SECONDS = 3600
+BATCH_SLOT_TTL_SECONDS = 25 * 3600 # Outlives the 24h completion window, so a lost batch frees its repo
+BATCH_LEASE_SECONDS = 90 # Renewed while a worker waits on a batch; once it lapses, another worker resumes it
+
 app = FastAPI(
     title="Technical Documentation Assistant API",
     description="API for indexing and querying code repositories.",
@@ -32,10 +56,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Answer-Source"],
 )
 
 # --- Production-Ready Redis Connection ---
+# Shared pools so every request reuses open connections instead of reconnecting.
+# The blocking pools wait for a free connection rather than erroring when all are busy.
 redis_client = None
+embedding_cache_client = None
 try:
     redis_url = os.getenv("REDIS_URL")
     if redis_url:
@@ -48,13 +76,12 @@ try:
         password = parsed_url.password
         username = parsed_url.username or 'default'
         
-        # Create Redis client with explicit parameters
-        redis_client = redis.Redis(
+        # Explicit connection parameters shared by both pools
+        redis_params = dict(
             host=hostname,
             port=port,
             username=username,
             password=password,
-            decode_responses=True,
             socket_connect_timeout=5,
             socket_keepalive=True,
             socket_keepalive_options={}
@@ -62,12 +89,18 @@ try:
         print(f"Redis client configured for {hostname}:{port}", flush=True)
     else:
         # Fallback for local development
-        redis_client = redis.Redis(
-            host='localhost', 
-            port=6379, 
-            decode_responses=True
-        )
+        redis_params = dict(host='localhost', port=6379)
         print("Redis client configured for localhost.", flush=True)
+    redis_client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        **redis_params
+    ))
+    # Cached embeddings are packed binary, so this client must not decode responses
+    embedding_cache_client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        max_connections=REDIS_MAX_CONNECTIONS,
+        **redis_params
+    ))
 except Exception as e:
     print(f"FATAL: Could not configure Redis client: {e}", flush=True)
 
@@ -79,53 +112,146 @@ class QueryRequest(BaseModel):
     repo_id: str
     question: str
 
-class QueryResponse(BaseModel):
-    answer: str
-    source: str
-
 # --- Caching Functions ---
-def get_cached_response(repo_id: str, question: str) -> str | None:
+def hash_question(question: str) -> str:
+    """Fixed-size digest of a question, so long questions don't produce long cache keys."""
+    return hashlib.blake2b(question.encode("utf-8"), digest_size=16).hexdigest()
+
+async def get_cached_response(repo_id: str, question: str) -> str | None:
     if not redis_client: return None
-    cache_key = f"query_cache:{repo_id}:{question}"
-    cached = redis_client.get(cache_key)
+    cache_key = f"query_cache:{repo_id}:{hash_question(question)}"
+    cached = await redis_client.get(cache_key)
     return json.loads(cached) if cached else None
 
-def set_cached_response(repo_id: str, question: str, response: dict):
-    if not redis_client: return
-    cache_key = f"query_cache:{repo_id}:{question}"
-    redis_client.setex(cache_key, 3600, json.dumps(response))
+async def get_semantic_cached_response(repo_id: str, query_embedding: list | None) -> str | None:
+    """Looks for the answer to a near-duplicate question in the semantic cache."""
+    if query_embedding is None: return None
+    return await aget_semantic_cache(query_embedding, repo_id, CACHE_TTL_SECONDS)
+
+async def set_cached_response(repo_id: str, question: str, response: dict, query_embedding: list | None = None):
+    question_hash = hash_question(question)
+    if redis_client:
+        cache_key = f"query_cache:{repo_id}:{question_hash}"
+        await redis_client.setex(cache_key, CACHE_TTL_SECONDS, json.dumps(response))
+    if query_embedding is not None:
+        await aset_semantic_cache(question_hash, question, query_embedding, repo_id, response["answer"])
 
 # --- Helper Functions for Indexing Status ---
-def check_if_indexed(repo_id: str) -> bool:
+async def check_if_indexed(repo_id: str) -> bool:
     if not redis_client: return False
-    return redis_client.exists(f"repo_indexed:{repo_id}")
+    return bool(await redis_client.exists(f"repo_indexed:{repo_id}"))
+
+async def get_index_state(repo_id: str) -> tuple[bool, dict | None]:
+    """Returns (is_indexed, batch_state) for a repo in a single round-trip."""
+    if not redis_client: return False, None
+    async with redis_client.pipeline(transaction=False) as pipe:
+        indexed, batch_state = await pipe.exists(f"repo_indexed:{repo_id}").get(f"repo_batch:{repo_id}").execute()
+    return bool(indexed), json.loads(batch_state) if batch_state else None
+
+async def mark_as_indexed(repo_id: str):
+    if redis_client:
+        # Flag the repo and drop its finished batch state in one round-trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(f"repo_indexed:{repo_id}", "true")
+            pipe.delete(f"repo_batch:{repo_id}", f"repo_batch_lease:{repo_id}")
+            await pipe.execute()
 
-def mark_as_indexed(repo_id: str):
+# Batch state is {"repo_url", "batch_ids", "fingerprint"}; until the jobs are submitted only
+# repo_url is set. It expires with the completion window, so a lost batch can't pin the repo.
+async def claim_index_batch(repo_id: str, repo_url: str) -> bool:
+    """Reserves the repo's batch slot and its lease; False if a batch job is already in flight for it."""
+    if not redis_client: return True
+    if not await redis_client.set(f"repo_batch:{repo_id}", json.dumps({"repo_url": repo_url}), nx=True, ex=BATCH_SLOT_TTL_SECONDS):
+        return False
+    await redis_client.set(f"repo_batch_lease:{repo_id}", "true", ex=BATCH_LEASE_SECONDS)
+    return True
+
+async def set_index_batch(repo_id: str, batch_state: dict):
+    if redis_client:
+        await redis_client.set(f"repo_batch:{repo_id}", json.dumps(batch_state), ex=BATCH_SLOT_TTL_SECONDS)
+
+async def clear_index_batch(repo_id: str):
     if redis_client:
-        redis_client.set(f"repo_indexed:{repo_id}", "true")
+        await redis_client.delete(f"repo_batch:{repo_id}", f"repo_batch_lease:{repo_id}")
+
+async def hold_batch_lease(repo_id: str):
+    """Renews the repo's batch lease until cancelled, so no other worker resumes the batch."""
+    if not redis_client: return
+    while True:
+        try:
+            await redis_client.set(f"repo_batch_lease:{repo_id}", "true", ex=BATCH_LEASE_SECONDS)
+        except Exception as e:
+            print(f"Error renewing batch lease for {repo_id}: {e}")
+        await asyncio.sleep(BATCH_LEASE_SECONDS / 3)
+
+async def take_over_batch(repo_id: str) -> bool:
+    """Claims the lease of a batch nobody is waiting on (the worker restarted); False if it is held."""
+    if not redis_client: return False
+    return bool(await redis_client.set(f"repo_batch_lease:{repo_id}", "true", nx=True, ex=BATCH_LEASE_SECONDS))
 
 # --- THIS IS THE ONE AND ONLY CORRECT VERSION of the background task ---
-def process_and_embed_repo(repo_url: str, repo_id: str):
+async def process_and_embed_repo(repo_url: str, repo_id: str, batch_state: dict | None = None):
     """
     The full pipeline function that will run in the background.
     It now marks the repo as indexed upon successful completion.
+    Files are streamed from the loader through the splitter into the embedder, so only a
+    window of chunks is held in memory at a time. Blocking steps (clone, file reads,
+    splitting, Batch API calls) run on the indexing executor, so neither the event loop
+    nor the default executor that /query relies on is tied up.
+    Pass the batch_state of an orphaned batch to resume waiting on it instead of submitting a new one.
     """
     print(f"Starting background indexing for {repo_id}...")
+    # Nothing is cloned or read until the embedding step starts pulling chunks
+    documents = load_github_repo(repo_url)
+    lease = None
+    release_batch_slot = USE_EMBEDDING_BATCH_API
     try:
-        documents = load_github_repo(repo_url)
-        if not documents:
-            print(f"No documents found or failed to load repo: {repo_id}")
-            return
-            
         chunks = get_text_chunks(documents)
-        create_embeddings_and_upsert(chunks, repo_id)
+        if USE_EMBEDDING_BATCH_API:
+            lease = asyncio.create_task(hold_batch_lease(repo_id))
+            # The Batch API input file needs every chunk up front
+            chunks = await run_in_indexing_thread(list, chunks)
+            if not chunks:
+                print(f"No documents found or failed to load repo: {repo_id}")
+                return
+            
+            # Results map back to chunks by position, so only resume against an unchanged repo
+            fingerprint = await run_in_indexing_thread(batch_plan_fingerprint, chunks)
+            batch_ids = (batch_state or {}).get("batch_ids")
+            if batch_ids and batch_state.get("fingerprint") == fingerprint:
+                print(f"Resuming embedding batches {batch_ids} for {repo_id}")
+            else:
+                if batch_ids:
+                    print(f"Repo {repo_id} changed since its batch was submitted. Submitting a new one.")
+                batch_ids = await run_in_indexing_thread(create_embeddings_via_batch_api, chunks, repo_id)
+                await set_index_batch(repo_id, {"repo_url": repo_url, "batch_ids": batch_ids, "fingerprint": fingerprint})
+            if not await wait_for_embedding_batch(batch_ids, chunks, repo_id):
+                print(f"Embedding batch failed for {repo_id}. Not marking as indexed.")
+                return
+        else:
+            if not await create_embeddings_and_upsert(chunks, repo_id, embedding_cache_client):
+                print(f"No documents found or failed to load repo: {repo_id}")
+                return
         
         # Mark as complete in Redis upon success
-        mark_as_indexed(repo_id)
+        await mark_as_indexed(repo_id)
+        release_batch_slot = False
         print(f"Successfully finished indexing for {repo_id}. Marked as complete.")
 
+    except asyncio.CancelledError:
+        # Shutting down mid-batch: keep the batch state so another worker can resume it
+        release_batch_slot = False
+        raise
     except Exception as e:
         print(f"An error occurred during background indexing for {repo_id}: {e}")
+    finally:
+        if lease:
+            lease.cancel()
+        if release_batch_slot:
+            # Failed, expired or never submitted: release the slot so status stops reporting it
+            await clear_index_batch(repo_id)
+        # Closing the loader removes the cloned repo if indexing stopped early
+        await run_in_indexing_thread(documents.close)
 
 # --- API Endpoints ---
 @app.get("/")
@@ -143,47 +269,100 @@ async def index_repo(request: RepoIndexRequest, background_tasks: BackgroundTask
     print(f"Generated repo_id: {repo_id}", flush=True)
     
     print("Checking if repo is already indexed...", flush=True)
-    if check_if_indexed(repo_id):
+    if await check_if_indexed(repo_id):
         print(f"Repo '{repo_id}' has already been indexed. Skipping.", flush=True)
         print("--- /index-repo endpoint END (Already Indexed) ---", flush=True)
         return {"status": "success", "message": f"Repository '{repo_id}' has already been indexed.", "repo_id": repo_id}
     
+    if USE_EMBEDDING_BATCH_API and not await claim_index_batch(repo_id, request.repo_url):
+        print(f"Repo '{repo_id}' already has an embedding batch in flight. Skipping.", flush=True)
+        print("--- /index-repo endpoint END (Batch In Flight) ---", flush=True)
+        return {"status": "pending", "message": f"Repository '{repo_id}' is already being indexed.", "repo_id": repo_id}
+    
     print("Repo not indexed. Adding task to background.", flush=True)
     background_tasks.add_task(process_and_embed_repo, request.repo_url, repo_id)
     
     print("--- /index-repo endpoint END (Task Added) ---", flush=True)
     return {"status": "pending", "message": f"Repository '{repo_id}' is being indexed in the background.", "repo_id": repo_id}
 
-@app.post("/query", response_model=QueryResponse)
+def answer_response(chunks, source: str) -> StreamingResponse:
+    """Wraps answer text as a plain-text stream; X-Answer-Source says whether it was cached."""
+    return StreamingResponse(chunks, media_type="text/plain", headers={"X-Answer-Source": source})
+
+@app.post("/query")
 async def query(request: QueryRequest):
     """
     Asks a question about an indexed repository, using a cache to store answers.
+    The answer is streamed back as plain text while it is being generated.
     """
-    cached_answer = get_cached_response(request.repo_id, request.question)
+    # Start embedding the question while the exact-match lookup runs, so a cache miss doesn't
+    # pay for the two round-trips back to back. A hit returns straight away without waiting on
+    # OpenAI. The embedding then serves both the semantic cache lookup and context retrieval.
+    embedding_task = asyncio.create_task(aembed_question(request.question))
+    try:
+        cached_answer = await get_cached_response(request.repo_id, request.question)
+    except BaseException:
+        embedding_task.cancel()
+        raise
     if cached_answer:
+        embedding_task.cancel()
         print(f"Cache hit for repo '{request.repo_id}'!")
-        return QueryResponse(answer=cached_answer['answer'], source="cache")
+        return answer_response(iter([cached_answer['answer']]), source="cache")
+    query_embedding = await embedding_task
+
+    # Both lookups only need the embedding, so run the Pinecone queries side by side
+    # rather than paying for the context query after a semantic miss
+    semantic_answer, context = await asyncio.gather(
+        get_semantic_cached_response(request.repo_id, query_embedding),
+        aget_context(request.question, request.repo_id, query_embedding=query_embedding)
+    )
+    if semantic_answer:
+        print(f"Semantic cache hit for repo '{request.repo_id}'!")
+        return answer_response(iter([semantic_answer]), source="cache")
 
     print(f"Cache miss. Generating new response for repo '{request.repo_id}'.")
     
-    context = get_context(request.question, request.repo_id)
     if not context:
         raise HTTPException(status_code=404, detail="Could not retrieve context. Please ensure the repository is indexed.")
 
-    generated_answer = generate_answer(request.question, context)
-    
-    response_data = {"answer": generated_answer}
-    set_cached_response(request.repo_id, request.question, response_data)
+    async def stream_and_cache():
+        answer_parts = []
+        try:
+            async for token in astream_answer(request.question, context):
+                answer_parts.append(token)
+                yield token
+        except Exception:
+            # The answer was cut off, so tell the client and leave it out of the cache
+            yield "Sorry, I encountered an error while generating the answer."
+            return
+        
+        # Only reached once the whole answer has been sent, so partial answers are never cached
+        response_data = {"answer": "".join(answer_parts)}
+        try:
+            await set_cached_response(request.repo_id, request.question, response_data, query_embedding)
+        except Exception as e:
+            print(f"Error caching response for repo '{request.repo_id}': {e}")
     
-    return QueryResponse(answer=generated_answer, source="generated")
+    return answer_response(stream_and_cache(), source="generated")
 
 @app.get("/index-status/{repo_id}")
-async def get_index_status(repo_id: str):
+async def get_index_status(repo_id: str, background_tasks: BackgroundTasks):
     """Checks if the repository has finished indexing."""
-    if check_if_indexed(repo_id):
+    indexed, batch_state = await get_index_state(repo_id)
+    if indexed:
         return {"status": "complete"}
-    else:
-        return {"status": "pending"}
+    
+    if batch_state:
+        if await take_over_batch(repo_id):
+            # The worker that submitted this batch went away (restart, redeploy), so pick it up here
+            print(f"Resuming orphaned indexing job for {repo_id}.", flush=True)
+            background_tasks.add_task(process_and_embed_repo, batch_state["repo_url"], repo_id, batch_state)
+        if batch_state.get("batch_ids"):
+            try:
+                return {"status": "pending", **await asyncio.to_thread(get_embedding_batch_status, batch_state["batch_ids"])}
+            except Exception as e:
+                print(f"Error retrieving embedding batch status for {repo_id}: {e}")
+    return {"status": "pending"}
 
 @app.get("/redis-health")
 async def redis_health_check():
@@ -191,7 +370,7 @@ async def redis_health_check():
     if not redis_client:
         return {"status": "error", "message": "Redis client is not initialized."}
     try:
-        ping_result = redis_client.ping()
+        ping_result = await redis_client.ping()
         return {"status": "ok", "ping_response": ping_result}
     except Exception as e:
         print(f"--- REDIS HEALTH CHECK FAILED ---", flush=True)
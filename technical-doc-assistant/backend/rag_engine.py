@@ -1,32 +1,65 @@
 # backend/rag_engine.py
 
 import os
+import time
+import asyncio
+from typing import AsyncIterator
 from pinecone import Pinecone
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # --- Initialization ---
 # Initialize clients from environment variables
 pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # --- Configuration ---
 PINECONE_INDEX_NAME = "doc-assistant"
-EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512 # Truncated embeddings; the Pinecone index must be created with this dimension
 LLM_MODEL = "gpt-3.5-turbo"  # A powerful and cost-effective model for generation
+PINECONE_POOL_THREADS = 10
+SEMANTIC_CACHE_THRESHOLD = 0.97 # Minimum cosine similarity for a cached question to count as a hit
+SEMANTIC_CACHE_SCAN_SIZE = 10 # Nearest cached questions checked per lookup; expired ones are deleted
 
-def get_context(question: str, repo_id: str, top_k: int = 5) -> str:
+# Create the index handle once so every query reuses its connection pool
+INDEX = pc.Index(PINECONE_INDEX_NAME, pool_threads=PINECONE_POOL_THREADS)
+
+# Fire-and-forget cleanup tasks; the event loop only keeps weak references to tasks
+_background_tasks = set()
+
+def _format_context(query_results) -> str:
+    """Joins retrieved matches into a single context string."""
+    context = ""
+    for match in query_results.matches:
+        # Add a separator and source information for clarity
+        context += f"--- Content from {match.metadata['source']} ---\n"
+        context += match.metadata['text'] + "\n"
+        
+    return context
+
+async def aembed_question(question: str) -> list | None:
+    """Creates an embedding for the user's question, or returns None on error."""
+    try:
+        res = await async_openai_client.embeddings.create(input=[question], model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+        return res.data[0].embedding
+    except Exception as e:
+        print(f"Error creating question embedding with OpenAI: {e}")
+        return None
+
+async def aget_context(question: str, repo_id: str, top_k: int = 5, query_embedding: list | None = None) -> str:
     """
     Retrieves the most relevant document chunks from Pinecone to serve as context.
+    Pass query_embedding to reuse an embedding that was already created for the question.
     """
     try:
-        index = pc.Index(PINECONE_INDEX_NAME)
-        
         # 1. Create an embedding for the user's question
-        res = openai_client.embeddings.create(input=[question], model=EMBEDDING_MODEL)
-        query_embedding = res.data[0].embedding
+        if query_embedding is None:
+            res = await async_openai_client.embeddings.create(input=[question], model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+            query_embedding = res.data[0].embedding
         
-        # 2. Query Pinecone for similar vectors
-        query_results = index.query(
+        # 2. Query Pinecone for similar vectors (the client is sync, so run it in a worker thread)
+        query_results = await asyncio.to_thread(
+            INDEX.query,
             namespace=repo_id,
             vector=query_embedding,
             top_k=top_k,
@@ -34,21 +67,71 @@ def get_context(question: str, repo_id: str, top_k: int = 5) -> str:
         )
         
         # 3. Format the retrieved context
-        context = ""
-        for match in query_results.matches:
-            # Add a separator and source information for clarity
-            context += f"--- Content from {match.metadata['source']} ---\n"
-            context += match.metadata['text'] + "\n"
-            
-        return context
+        return _format_context(query_results)
     except Exception as e:
         print(f"Error retrieving context from Pinecone: {e}")
         return "" # Return empty context on error
 
-def generate_answer(question: str, context: str) -> str:
-    """
-    Uses the GPT model to generate an answer based on the provided context.
-    """
+# --- Semantic Cache ---
+# Answered questions are stored in a separate "cache:{repo_id}" namespace so near-duplicate
+# questions can reuse an answer without another LLM call. Entries are keyed by question hash,
+# so asking the same question again overwrites its entry; expired entries near a lookup are deleted.
+async def aget_semantic_cache(query_embedding: list, repo_id: str, max_age_seconds: int) -> str | None:
+    """Returns the cached answer of the most similar previous question, if it is close enough."""
+    namespace = f"cache:{repo_id}"
+    try:
+        query_results = await asyncio.to_thread(
+            INDEX.query,
+            namespace=namespace,
+            vector=query_embedding,
+            top_k=SEMANTIC_CACHE_SCAN_SIZE,
+            include_metadata=True
+        )
+        
+        # Matches come back most similar first
+        now = time.time()
+        answer = None
+        expired_ids = []
+        for match in query_results.matches:
+            if now - match.metadata.get("cached_at", 0) > max_age_seconds:
+                expired_ids.append(match.id)
+            elif answer is None and match.score >= SEMANTIC_CACHE_THRESHOLD:
+                answer = match.metadata["answer"]
+        
+        if expired_ids:
+            # Cleanup doesn't affect this answer, so don't make the caller wait for it
+            task = asyncio.create_task(_delete_semantic_cache_entries(expired_ids, namespace))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+        return answer
+    except Exception as e:
+        print(f"Error reading semantic cache from Pinecone: {e}")
+        return None
+
+async def _delete_semantic_cache_entries(ids: list, namespace: str):
+    """Removes expired entries from a semantic cache namespace."""
+    try:
+        await asyncio.to_thread(INDEX.delete, ids=ids, namespace=namespace)
+    except Exception as e:
+        print(f"Error deleting expired semantic cache entries from Pinecone: {e}")
+
+async def aset_semantic_cache(cache_id: str, question: str, query_embedding: list, repo_id: str, answer: str):
+    """Stores a question's embedding and its answer in the semantic cache namespace."""
+    try:
+        await asyncio.to_thread(
+            INDEX.upsert,
+            vectors=[{
+                "id": cache_id,
+                "values": query_embedding,
+                "metadata": {"question": question, "answer": answer, "cached_at": time.time()}
+            }],
+            namespace=f"cache:{repo_id}"
+        )
+    except Exception as e:
+        print(f"Error writing semantic cache to Pinecone: {e}")
+
+def _build_messages(question: str, context: str) -> list:
+    """Builds the chat messages that ground the model in the retrieved context."""
     # This is the prompt engineering part. We instruct the model how to behave.
     system_prompt = (
         "You are a helpful assistant for software developers. "
@@ -60,16 +143,26 @@ def generate_answer(question: str, context: str) -> str:
     
     user_prompt = f"Context:\n{context}\n\nQuestion: {question}\n\nAnswer:"
     
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+async def astream_answer(question: str, context: str) -> AsyncIterator[str]:
+    """
+    Streams the generated answer token by token, so the client sees text as soon as it arrives.
+    Errors are logged and re-raised, so the caller can tell a cut-off answer from a complete one.
+    """
     try:
-        response = openai_client.chat.completions.create(
+        stream = await async_openai_client.chat.completions.create(
             model=LLM_MODEL,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.1 # A low temperature encourages more deterministic, factual answers
+            messages=_build_messages(question, context),
+            temperature=0.1, # A low temperature encourages more deterministic, factual answers
+            stream=True
         )
-        return response.choices[0].message.content
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
     except Exception as e:
         print(f"Error generating answer with OpenAI: {e}")
-        return "Sorry, I encountered an error while generating the answer."
\ No newline at end of file
+        raise
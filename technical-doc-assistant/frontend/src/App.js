@@ -80,12 +80,32 @@ function App() {
           return;
         }
         addMessageToHistory("Thinking...", 'bot-status');
-        const response = await axios.post(`${API_URL}/query`, { repo_id: repoId, question: currentInput });
-        setChatHistory(prev => {
-          const newHistory = [...prev];
-          newHistory[newHistory.length - 1] = { text: response.data.answer, sender: 'bot' };
-          return newHistory;
+        // The answer is streamed as plain text, so read it chunk by chunk instead of using axios
+        const response = await fetch(`${API_URL}/query`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ repo_id: repoId, question: currentInput }),
         });
+        if (!response.ok) {
+          const errorData = await response.json().catch(() => ({}));
+          throw new Error(errorData.detail || `Request failed with status ${response.status}`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let answer = '';
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          answer += decoder.decode(value, { stream: true });
+          const partialAnswer = answer;
+          // Replace the "Thinking..." placeholder with the answer so far
+          setChatHistory(prev => {
+            const newHistory = [...prev];
+            newHistory[newHistory.length - 1] = { text: partialAnswer, sender: 'bot' };
+            return newHistory;
+          });
+        }
         setIsLoading(false);
       }
     } catch (error) {